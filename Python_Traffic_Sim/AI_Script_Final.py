@@ -6,9 +6,13 @@
 
 import maya.cmds as cmds
 import random
+import csv
+import time
 from math import sqrt
+from collections import deque
 
 # Maya expression editor: add - python("update("+frame+")");
+# For lookahead playback use instead - python("playback("+frame+")");
 
 # preset velocities
 velocity1 = (0,0,-1)
@@ -43,12 +47,74 @@ carList = [['car1',3, -1, 0, 2], ['car2',2, -1, 0, 2], ['car3',2, -1, 0, 2], ['c
 # List of all crash locations
 crashList = []
 
+# Turn started by the last call to turnLeft (0) or turnRight (1)
+lastTurn = -1
+
+# Turn taken by every car that entered a junction on the last update() (-1 if none)
+frameTurns = []
+
 # List of building sets
 buildingList = ['buildingSet1', 'buildingSet2', 'buildingSet3', 'buildingSet4', 'buildingSet5', 'buildingSet6', 'buildingSet7', 'buildingSet8', 'buildingSet9']
 
 # List of taxi stands
 taxiStandList = ['taxiStand1', 'taxiStand2', 'taxiStand3', 'taxiStand4', 'taxiStand5', 'taxiStand6']
 
+# Lookahead simulation
+# lookaheadSize  = maximum number of precomputed frames held in the queue
+# lookaheadQueue = precomputed frames, each [frame, car transforms, new crash locators, car states, junction turns]
+# simFrame       = next frame the simulation will compute (None until playback starts)
+# lookaheadSlice = seconds the idle scriptJob may spend simulating ahead per idle event
+# simTransforms  = car transforms at the simulation frame (None if the same as what is displayed)
+# playFrame      = last frame applied by playback() (None until playback starts)
+# playStates     = carList states (elements 1 to 4) at the last frame applied by playback()
+# lookaheadJob   = id of the idle scriptJob filling the queue (-1 if not running)
+# lookaheadStepping = True while stepAhead() runs update(), so analytics wait until the frame is played
+
+# Clean up after a previous run of this script so its idle scriptJob and hidden crash locators are not orphaned
+if 'lookaheadJob' in globals() and lookaheadJob != -1 and cmds.scriptJob(exists=lookaheadJob):
+    cmds.scriptJob(kill=lookaheadJob, force=True)
+if 'lookaheadQueue' in globals():
+    for entry in lookaheadQueue:
+        for locator in entry[2]:
+            if cmds.objExists(locator[0]):
+                cmds.delete(locator)
+
+lookaheadSize = 300
+lookaheadQueue = deque()
+lookaheadSlice = 0.02
+simFrame = None
+simTransforms = None
+playFrame = None
+playStates = None
+lookaheadJob = -1
+lookaheadStepping = False
+
+# Traffic analytics (see resetAnalytics)
+# analyticsEnabled = if True, update() feeds the analytics below
+# analyticsBounds  = streetMap bounds used for the heatmap grid [minX, minZ, maxX, maxZ]
+# analyticsCell    = size of a heatmap cell
+# hotspotCell      = size of a cell used to cluster crashes
+# queueRadius      = distance from a junction within which stopped cars count as queueing
+# heatmap          = car occupancy count per cell, heatmap[row][column] (row along z, column along x)
+# junctionStats    = per juncList entry: [entries, left, right, straight, queue total, queue max]
+# junctionCentres  = per juncList entry: [x, z] centre of the junction
+# crashHotspots    = crash count per hotspot cell, keyed by (column, row)
+# analyticsFrames  = number of frames recorded
+# prevStates       = state of every car on the previous frame recorded
+# prevJunctions    = junction index of every car on the previous frame recorded
+analyticsEnabled = False
+analyticsBounds = []
+analyticsCell = 5.0
+hotspotCell = 10.0
+queueRadius = 15.0
+heatmap = []
+junctionStats = []
+junctionCentres = []
+crashHotspots = {}
+analyticsFrames = 0
+prevStates = []
+prevJunctions = []
+
 
 #========================================================================
 # ACTION AND BEHAVIOUR FUNCTIONS
@@ -57,6 +123,8 @@ def turnLeft(car):
     """Rotates the car to the left.
     Used when turning at junction.
     State 0"""
+    global lastTurn
+    lastTurn = 0
     cmds.xform(car, t=velocity1, r=True, os=True)
     cmds.xform(car, ro=(0,10,0), r=True, os=True, p=True)
 
@@ -64,6 +132,8 @@ def turnRight(car):
     """Rotates the car to the right.
     Used when turning at junction.
     State 1"""
+    global lastTurn
+    lastTurn = 1
     cmds.xform(car, t=velocity3, r=True, os=True)
     cmds.xform(car, ro=(0,-10,0), r=True, os=True, p=True)
     
@@ -257,6 +327,7 @@ def fixAngles(obj1, listNum):
 def update(frame):
     """Main AI function that executes all car behaviour.
     Run in expression editor: python("update("+frame+")");"""
+    global lastTurn, frameTurns
     decision = 0
     
     # Check and clamp angle of cars in scene
@@ -488,6 +559,7 @@ def update(frame):
     
     # Determines decision for cars to make if at a junction
     # Also updates car if turning or if going straight       
+    turns = [-1] * len(carList)
     for i in range (0, len(carList)):
         carRotation = cmds.xform(carList[i][0], ro=True, q=True)
         carAngle = carRotation[1]
@@ -506,6 +578,7 @@ def update(frame):
             carList[i][2] = -1
         if (count < len(juncList) and carList[i][2] == -1):
             carList[i][2] = j
+            lastTurn = -1
             
             # Different junction type behaviours
             
@@ -647,6 +720,8 @@ def update(frame):
                         carList[i][1] = 0
                     elif decision == 1:
                         carList[i][1] = 2
+            
+            turns[i] = lastTurn
       
         if carAngle%90.0 > 0.0 and carList[i][1] == 0:
             turnLeft(carList[i][0])
@@ -656,13 +731,338 @@ def update(frame):
             goStraight(carList[i][0])
         elif carList[i][1] == 4:
             goSlow(carList[i][0])
+    
+    frameTurns = turns
+    if analyticsEnabled and not lookaheadStepping:
+        recordSceneFrame(turns)
             
                 
 
+#========================================================================
+# LOOKAHEAD FUNCTIONS
+#========================================================================
+def captureTransforms():
+    """Returns the translation and rotation of every car in carList."""
+    transforms = []
+    for i in range (0, len(carList)):
+        pos = cmds.xform(carList[i][0], t=True, q=True)
+        rot = cmds.xform(carList[i][0], ro=True, q=True)
+        transforms.append([pos, rot])
+    return transforms
+
+def applyTransforms(transforms):
+    """Sets the translation and rotation of every car in carList.
+    Takes a list as returned by captureTransforms()."""
+    for i in range (0, len(carList)):
+        cmds.xform(carList[i][0], t=transforms[i][0], ro=transforms[i][1])
+
+def captureStates():
+    """Returns a copy of the state, junction, count and previous state of every car in carList."""
+    states = []
+    for i in range (0, len(carList)):
+        states.append(list(carList[i][1:]))
+    return states
+
+def stepAhead():
+    """Simulates one frame ahead of the playhead and stores the result in lookaheadQueue.
+    The displayed car transforms are left untouched.
+    If the simulation fails the idle scriptJob is stopped."""
+    global simFrame, simTransforms, lookaheadStepping
+    if simFrame is None:
+        return
+    
+    # Keep the simulation's transform changes out of the undo queue
+    undoState = cmds.undoInfo(q=True, stateWithoutFlush=True)
+    cmds.undoInfo(stateWithoutFlush=False)
+    shown = None
+    crashCount = len(crashList)
+    try:
+        shown = captureTransforms()
+        if simTransforms is not None:
+            applyTransforms(simTransforms)
+        lookaheadStepping = True
+        update(simFrame)
+        simTransforms = captureTransforms()
+        
+        # Crash locators are hidden until playback reaches the frame they were created on
+        newCrashes = crashList[crashCount:]
+        for i in range (0, len(newCrashes)):
+            cmds.hide(newCrashes[i])
+    except Exception:
+        # The scriptJob can't be killed from inside its own callback
+        cmds.evalDeferred(killLookaheadJob)
+        raise
+    finally:
+        lookaheadStepping = False
+        if shown is not None:
+            applyTransforms(shown)
+        cmds.undoInfo(stateWithoutFlush=undoState)
+    
+    lookaheadQueue.append([simFrame, simTransforms, newCrashes, captureStates(), list(frameTurns)])
+    simFrame = simFrame + 1
+
+def lookaheadIdle():
+    """Called by the idle scriptJob.
+    Fills lookaheadQueue for up to lookaheadSlice seconds, always simulating at least one frame if there is room."""
+    start = time.time()
+    while len(lookaheadQueue) < lookaheadSize:
+        stepAhead()
+        if time.time() - start >= lookaheadSlice:
+            break
+
+def discardLookahead():
+    """Throws away the frames in lookaheadQueue that have not been played yet.
+    Their crash locators are deleted and removed from crashList, and carList is returned to the last frame played."""
+    global simFrame, simTransforms
+    if len(lookaheadQueue) == 0:
+        return
+    for entry in lookaheadQueue:
+        for locator in entry[2]:
+            crashList.remove(locator)
+            if cmds.objExists(locator[0]):
+                cmds.delete(locator)
+    lookaheadQueue.clear()
+    
+    if playStates is not None:
+        for i in range (0, len(carList)):
+            carList[i][1:] = list(playStates[i])
+    simTransforms = None
+    if playFrame is not None:
+        simFrame = playFrame + 1
+
+def startLookahead(size=300, startFrame=None):
+    """Starts simulating up to size frames ahead of the playhead while Maya is idle.
+    Use with the expression: python("playback("+frame+")");"""
+    global lookaheadSize, lookaheadJob, simFrame, simTransforms, playFrame, playStates
+    stopLookahead()
+    if startFrame is None:
+        startFrame = cmds.currentTime(q=True)
+    lookaheadSize = size
+    simFrame = int(startFrame)
+    simTransforms = None
+    playFrame = None
+    playStates = captureStates()
+    lookaheadJob = cmds.scriptJob(event=['idle', lookaheadIdle], killWithScene=True)
+    
+def killLookaheadJob():
+    """Kills the idle scriptJob filling the lookahead queue, if it is running."""
+    global lookaheadJob
+    if lookaheadJob != -1 and cmds.scriptJob(exists=lookaheadJob):
+        cmds.scriptJob(kill=lookaheadJob, force=True)
+    lookaheadJob = -1
+    
+def stopLookahead():
+    """Stops the idle scriptJob filling the lookahead queue.
+    Frames not played yet are discarded, so update() can carry on from the frame shown."""
+    killLookaheadJob()
+    discardLookahead()
+
+def playback(frame):
+    """Applies the next precomputed frame of the simulation.
+    Moving forward applies one simulated frame per timeline frame, but never simulates more than one frame on demand,
+    so jumping far ahead doesn't stall. Like update(), going back (e.g. the timeline looping) carries on with the next frame.
+    Run in expression editor: python("playback("+frame+")");"""
+    global simFrame, simTransforms, playFrame, playStates
+    frame = int(frame)
+    if simFrame is None:
+        simFrame = frame
+        simTransforms = None
+        playStates = captureStates()
+    
+    steps = 1
+    if playFrame is not None and frame > playFrame:
+        steps = min(frame - playFrame, max(1, len(lookaheadQueue)))
+    playFrame = frame
+    
+    # Playhead has caught up with the lookahead, the scene already shows the simulation frame so just update it
+    if len(lookaheadQueue) == 0:
+        update(simFrame)
+        simFrame = simFrame + 1
+        simTransforms = None
+        playStates = captureStates()
+        return
+    
+    for step in range (0, steps):
+        current = lookaheadQueue.popleft()
+        for i in range (0, len(current[2])):
+            cmds.showHidden(current[2][i])
+        
+        # Analytics only count frames once they are played, so discarded frames are never recorded
+        if analyticsEnabled:
+            positions = [transform[0] for transform in current[1]]
+            states = [carState[0] for carState in current[3]]
+            junctions = [carState[1] for carState in current[3]]
+            recordFrame(positions, states, junctions, current[4])
+    playStates = current[3]
+    applyTransforms(current[1])
+
+
+#========================================================================
+# ANALYTICS FUNCTIONS
+#========================================================================
+def resetAnalytics(cellSize=5.0, hotspotSize=10.0, radius=15.0):
+    """Clears and enables traffic analytics.
+    Builds a heatmap grid of cellSize cells over streetMap, clusters crashes into cells of hotspotSize
+    and counts stopped cars within radius of a junction as queueing.
+    Run before each simulation run, then export with exportAnalyticsCSV() or exportAnalyticsNPZ()."""
+    global analyticsEnabled, analyticsBounds, analyticsCell, hotspotCell, queueRadius
+    global heatmap, junctionStats, junctionCentres, crashHotspots, analyticsFrames, prevStates, prevJunctions
+    bbox = cmds.exactWorldBoundingBox('streetMap')
+    analyticsBounds = [bbox[0], bbox[2], bbox[3], bbox[5]]
+    analyticsCell = float(cellSize)
+    hotspotCell = float(hotspotSize)
+    queueRadius = float(radius)
+    
+    columns = int((analyticsBounds[2] - analyticsBounds[0]) / analyticsCell) + 1
+    rows = int((analyticsBounds[3] - analyticsBounds[1]) / analyticsCell) + 1
+    heatmap = [[0] * columns for r in range (0, rows)]
+    
+    junctionStats = []
+    junctionCentres = []
+    for j in range (0, len(juncList)):
+        junctionStats.append([0, 0, 0, 0, 0, 0])
+        jbox = cmds.exactWorldBoundingBox(juncList[j][0])
+        junctionCentres.append([(jbox[0] + jbox[3]) / 2.0, (jbox[2] + jbox[5]) / 2.0])
+    
+    crashHotspots = {}
+    analyticsFrames = 0
+    prevStates = []
+    prevJunctions = []
+    analyticsEnabled = True
+    
+def stopAnalytics():
+    """Stops update() feeding the analytics. Recorded results are kept for export."""
+    global analyticsEnabled
+    analyticsEnabled = False
+
+def recordSceneFrame(turns):
+    """Adds the current scene and carList to the analytics.
+    Called by update() with the turn taken by every car that entered a junction this frame."""
+    positions = []
+    states = []
+    junctions = []
+    for i in range (0, len(carList)):
+        positions.append(cmds.xform(carList[i][0], t=True, q=True))
+        states.append(carList[i][1])
+        junctions.append(carList[i][2])
+    recordFrame(positions, states, junctions, turns)
+
+def recordFrame(positions, states, junctions, turns):
+    """Adds one frame to the analytics, either live from recordSceneFrame() or from a recorded run.
+    Takes per car: position [x, y, z], state (carList element 1), junction index (carList element 2)
+    and the turn taken if it entered a junction this frame (0 = left, 1 = right, -1 = neither).
+    A car's state changing to -1 counts as a crash and its junction index changing from -1 counts as
+    a junction entry. Both compare with the previous frame, so they are not counted on the first frame."""
+    global analyticsFrames, prevStates, prevJunctions
+    if len(prevStates) != len(states):
+        prevStates = list(states)
+        prevJunctions = list(junctions)
+    
+    queues = [0] * len(junctionStats)
+    for i in range (0, len(positions)):
+        x = positions[i][0]
+        z = positions[i][2]
+        column = int((x - analyticsBounds[0]) // analyticsCell)
+        row = int((z - analyticsBounds[1]) // analyticsCell)
+        if row >= 0 and row < len(heatmap) and column >= 0 and column < len(heatmap[row]):
+            heatmap[row][column] = heatmap[row][column] + 1
+        
+        if states[i] == -1 and prevStates[i] != -1:
+            recordCrash(positions[i])
+        if junctions[i] != -1 and prevJunctions[i] == -1:
+            recordJunctionEntry(junctions[i], turns[i])
+        
+        # Stopped cars are queueing for the nearest junction within queueRadius
+        if states[i] != 3:
+            continue
+        nearest = -1
+        nearestDistance = queueRadius
+        for j in range (0, len(junctionCentres)):
+            finalX = x - junctionCentres[j][0]
+            finalZ = z - junctionCentres[j][1]
+            distance = sqrt((finalX*finalX) + (finalZ*finalZ))
+            if distance < nearestDistance:
+                nearest = j
+                nearestDistance = distance
+        if nearest != -1:
+            queues[nearest] = queues[nearest] + 1
+    
+    for j in range (0, len(junctionStats)):
+        junctionStats[j][4] = junctionStats[j][4] + queues[j]
+        if queues[j] > junctionStats[j][5]:
+            junctionStats[j][5] = queues[j]
+    prevStates = list(states)
+    prevJunctions = list(junctions)
+    analyticsFrames = analyticsFrames + 1
+    
+def recordJunctionEntry(juncIndex, turn):
+    """Counts a car entering a junction and the turn it took.
+    Turn 0 = left, 1 = right, anything else = straight."""
+    stats = junctionStats[juncIndex]
+    stats[0] = stats[0] + 1
+    if turn == 0 or turn == 1:
+        stats[turn + 1] = stats[turn + 1] + 1
+    else:
+        stats[3] = stats[3] + 1
+        
+def recordCrash(pos):
+    """Adds a crash at the given position to the crash hotspot cell it falls in."""
+    key = (int((pos[0] - analyticsBounds[0]) // hotspotCell), int((pos[2] - analyticsBounds[1]) // hotspotCell))
+    crashHotspots[key] = crashHotspots.get(key, 0) + 1
+    
+def hotspotList():
+    """Returns the crash hotspots as [centre x, centre z, crashes], most crashes first."""
+    hotspots = []
+    for key, count in crashHotspots.items():
+        hotspots.append([analyticsBounds[0] + (key[0] + 0.5) * hotspotCell, analyticsBounds[1] + (key[1] + 0.5) * hotspotCell, count])
+    hotspots.sort(key=lambda hotspot: -hotspot[2])
+    return hotspots
+    
+def exportAnalyticsCSV(path):
+    """Writes the analytics to three CSV files:
+    path_heatmap.csv, path_junctions.csv and path_crashes.csv"""
+    f = open(path + '_heatmap.csv', 'wb')
+    writer = csv.writer(f)
+    for r in range (0, len(heatmap)):
+        writer.writerow(heatmap[r])
+    f.close()
+    
+    f = open(path + '_junctions.csv', 'wb')
+    writer = csv.writer(f)
+    writer.writerow(['junction', 'type', 'entries', 'left', 'right', 'straight', 'mean queue', 'max queue'])
+    for j in range (0, len(junctionStats)):
+        stats = junctionStats[j]
+        meanQueue = 0.0
+        if analyticsFrames > 0:
+            meanQueue = stats[4] / float(analyticsFrames)
+        writer.writerow([juncList[j][0], juncList[j][1]] + stats[:4] + [meanQueue, stats[5]])
+    f.close()
+    
+    f = open(path + '_crashes.csv', 'wb')
+    writer = csv.writer(f)
+    writer.writerow(['centre x', 'centre z', 'crashes'])
+    writer.writerows(hotspotList())
+    f.close()
+    
+def exportAnalyticsNPZ(path):
+    """Writes the analytics to a numpy .npz file.
+    Requires numpy, which is not shipped with Maya 2014."""
+    try:
+        import numpy
+    except ImportError:
+        print 'numpy is not available, use exportAnalyticsCSV instead'
+        return
+    numpy.savez(path, heatmap=numpy.array(heatmap), junctions=numpy.array(junctionStats), crashes=numpy.array(hotspotList()).reshape(-1, 3), frames=analyticsFrames, bounds=numpy.array(analyticsBounds))
+
+
 #========================================================================
 # RESET FUNCTIONS
 #========================================================================
 def reset():
+    global simFrame, playFrame
+    stopLookahead()
+    simFrame = None
+    playFrame = None
     cmds.xform('car1', t=(2,1,20), ro=(0,0,0))
     cmds.xform('car2', t=(-30,1,-2), ro=(0,90,0))
     cmds.xform('car3', t=(-2,1,25), ro=(0,180,0))